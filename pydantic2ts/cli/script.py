@@ -1,26 +1,58 @@
-import argparse
 import importlib
-import inspect
 import json
 import logging
 import os
+import re
 import shutil
 import sys
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
 from importlib.util import module_from_spec, spec_from_file_location
-from tempfile import mkdtemp
+from pathlib import Path
 from types import ModuleType
-from typing import Any, Dict, List, Tuple, Type
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
 from uuid import uuid4
 
-from pydantic import BaseModel, Extra, create_model
+from pydantic import BaseModel, Extra
+from pydantic.json import pydantic_encoder
+from pydantic.schema import (
+    get_flat_models_from_models,
+    get_model_name_map,
+    model_process_schema,
+)
 
 try:
     from pydantic.generics import GenericModel
 except ImportError:
     GenericModel = None
 
+if TYPE_CHECKING:
+    import argparse
+
 logger = logging.getLogger("pydantic2ts")
 
+_BANNER_COMMENT = (
+    "/* tslint:disable */\n"
+    "/* eslint-disable */\n"
+    "/**\n"
+    "/* This file was automatically generated from pydantic models by running pydantic2ts.\n"
+    "/* Do not modify it by hand - just update the pydantic models and then re-run the script\n"
+    "*/\n\n"
+)
+
+_MASTER_INTERFACE_RE = re.compile(
+    r"^export interface _Master_ \{\r?$.*?^\}\r?$\n?", re.MULTILINE | re.DOTALL
+)
+
 
 def import_module(path: str) -> ModuleType:
     """
@@ -51,7 +83,7 @@ def is_submodule(obj, module_name: str) -> bool:
     """
     Return true if an object is a submodule
     """
-    return inspect.ismodule(obj) and getattr(obj, "__name__", "").startswith(
+    return isinstance(obj, ModuleType) and getattr(obj, "__name__", "").startswith(
         f"{module_name}."
     )
 
@@ -61,67 +93,70 @@ def is_concrete_pydantic_model(obj) -> bool:
     Return true if an object is a concrete subclass of pydantic's BaseModel.
     'concrete' meaning that it's not a GenericModel.
     """
-    if not inspect.isclass(obj):
+    if not isinstance(obj, type):
         return False
-    elif obj is BaseModel:
+    return _is_concrete_pydantic_class(obj)
+
+
+@lru_cache(maxsize=None)
+def _is_concrete_pydantic_class(cls: type) -> bool:
+    """
+    Cached implementation of :func:`is_concrete_pydantic_model` for classes,
+    which are frequently re-exported and therefore seen many times.
+    """
+    if cls is BaseModel:
         return False
-    elif GenericModel and issubclass(obj, GenericModel):
-        return bool(obj.__concrete__)
+    elif GenericModel and issubclass(cls, GenericModel):
+        return bool(cls.__concrete__)
     else:
-        return issubclass(obj, BaseModel)
+        return issubclass(cls, BaseModel)
 
 
 def extract_pydantic_models(module: ModuleType) -> List[Type[BaseModel]]:
     """
     Given a module, return a list of the pydantic models contained within it.
+
+    Members are scanned via the module's __dict__ rather than 'inspect.getmembers',
+    which is noticeably slower for large modules. They are still visited in sorted
+    order so that the generated output is stable.
+
+    Submodules are walked depth-first with an explicit stack (so deeply nested packages
+    can't hit the recursion limit), each is only scanned once, and models which are
+    reachable through multiple modules (ex: re-exports) are only returned once.
     """
     models = []
-    module_name = module.__name__
-
-    for _, model in inspect.getmembers(module, is_concrete_pydantic_model):
-        models.append(model)
+    seen = set()
+    stack = [module]
 
-    for _, submodule in inspect.getmembers(
-        module, lambda obj: is_submodule(obj, module_name)
-    ):
-        models.extend(extract_pydantic_models(submodule))
+    while stack:
+        module = stack.pop()
+        if id(module) in seen:
+            continue
+        seen.add(id(module))
 
-    return models
+        module_name = module.__name__
+        submodules = []
 
+        for _, obj in sorted(vars(module).items(), key=lambda item: item[0]):
+            if isinstance(obj, type):
+                if _is_concrete_pydantic_class(obj):
+                    models.append(obj)
+            elif is_submodule(obj, module_name):
+                submodules.append(obj)
 
-def clean_output_file(output_filename: str) -> None:
-    """
-    Clean up the output file typescript definitions were written to by:
-    1. Removing the 'master model'.
-       This is a faux pydantic model with references to all the *actual* models necessary for generating
-       clean typescript definitions without any duplicates. We don't actually want it in the output, so
-       this function removes it from the generated typescript file.
-    2. Adding a banner comment with clear instructions for how to regenerate the typescript definitions.
-    """
-    with open(output_filename, "r") as f:
-        lines = f.readlines()
+        stack.extend(reversed(submodules))
 
-    start, end = None, None
-    for i, line in enumerate(lines):
-        if line.rstrip("\r\n") == "export interface _Master_ {":
-            start = i
-        elif (start is not None) and line.rstrip("\r\n") == "}":
-            end = i
-            break
+    return list(dict.fromkeys(models))
 
-    banner_comment_lines = [
-        "/* tslint:disable */\n",
-        "/* eslint-disable */\n",
-        "/**\n",
-        "/* This file was automatically generated from pydantic models by running pydantic2ts.\n",
-        "/* Do not modify it by hand - just update the pydantic models and then re-run the script\n",
-        "*/\n\n",
-    ]
 
-    new_lines = banner_comment_lines + lines[:start] + lines[(end + 1) :]
+def remove_master_interface(typescript: str) -> str:
+    """
+    Remove the 'master model' from the typescript definitions generated by json2ts.
 
-    with open(output_filename, "w") as f:
-        f.writelines(new_lines)
+    This is a faux object with references to all the *actual* models necessary for generating
+    clean typescript definitions without any duplicates. We don't actually want it in the output.
+    """
+    return _MASTER_INTERFACE_RE.sub("", typescript, count=1)
 
 
 def clean_schema(schema: Dict[str, Any]) -> None:
@@ -141,41 +176,143 @@ def clean_schema(schema: Dict[str, Any]) -> None:
         del schema["description"]
 
 
-def generate_json_schema(models: List[Type[BaseModel]]) -> str:
+@lru_cache(maxsize=None)
+def _import_orjson() -> Optional[ModuleType]:
+    """
+    Import orjson on first use, so it isn't loaded unless a schema is actually serialized.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def dump_json_schema(schema: Dict[str, Any]) -> bytes:
+    """
+    Serialize a JSON schema to UTF-8 encoded bytes.
+
+    orjson is used if it's installed since it's considerably faster for large schemas,
+    otherwise we fall back to the standard library.
+    """
+    orjson = _import_orjson()
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                schema, default=pydantic_encoder, option=orjson.OPT_INDENT_2
+            )
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(schema, indent=2, default=pydantic_encoder).encode("utf-8")
+
+
+@contextmanager
+def forbid_extra(model: Type[BaseModel]) -> Iterator[None]:
+    """
+    Temporarily set a model's 'extra' setting to 'forbid', unless it was explicitly set to 'allow'.
+    Models which don't need to change are left untouched.
+    """
+    extra = getattr(model.Config, "extra", None)
+    if extra in (Extra.allow, Extra.forbid):
+        yield
+        return
+
+    # Remember whether 'extra' was set on this model's own Config (rather than inherited),
+    # so that restoring it doesn't leave behind an override which wasn't there before.
+    overridden = "extra" in vars(model.Config)
+    model.Config.extra = Extra.forbid
+    try:
+        yield
+    finally:
+        if overridden:
+            model.Config.extra = extra
+        else:
+            del model.Config.extra
+
+
+def generate_json_schema(models: List[Type[BaseModel]]) -> bytes:
     """
-    Create a top-level '_Master_' model with references to each of the actual models.
-    Generate the schema for this model, which will include the schemas for all the
-    nested models. Then clean up the schema.
+    Generate a schema with the definitions for all the models (and any nested models),
+    plus a top-level '_Master_' object with references to each of the actual models.
+    Then clean up the schema.
+
+    The '_Master_' object is built directly rather than by creating a pydantic model for it,
+    which would make pydantic do an extra round of schema generation for its fields.
 
     One weird thing we do is we temporarily override the 'extra' setting in models,
     changing it to 'forbid' UNLESS it was explicitly set to 'allow'. This prevents
     '[k: string]: any' from being added to every interface. This change is reverted
-    once the schema has been generated.
+    (see :func:`forbid_extra`) once the schema has been generated.
     """
-    model_extras = [getattr(m.Config, "extra", None) for m in models]
-
-    try:
+    with ExitStack() as stack:
         for m in models:
-            if getattr(m.Config, "extra", None) != Extra.allow:
-                m.Config.extra = Extra.forbid
+            stack.enter_context(forbid_extra(m))
 
-        master_model = create_model(
-            "_Master_", **{m.__name__: (m, ...) for m in models}
-        )
-        master_model.Config.extra = Extra.forbid
-        master_model.Config.schema_extra = staticmethod(clean_schema)
+        # Like the fields of the old '_Master_' model, models are keyed by their class name,
+        # and if several share a name the last one wins.
+        models_by_name = {m.__name__: m for m in models}
+        models = list(models_by_name.values())
+        model_name_map = get_model_name_map(get_flat_models_from_models(models))
 
-        schema = json.loads(master_model.schema_json())
+        # This is what pydantic.schema.schema does, except that we hold on to model_name_map
+        # rather than having pydantic walk all the models a second time to rebuild it.
+        definitions = {}
+        for m in models:
+            m_schema, m_definitions, _ = model_process_schema(
+                m, model_name_map=model_name_map
+            )
+            definitions.update(m_definitions)
+            definitions[model_name_map[m]] = m_schema
 
-        for d in schema.get("definitions", {}).values():
+        for d in definitions.values():
             clean_schema(d)
 
-        return json.dumps(schema, indent=2)
+        schema = {
+            "title": "_Master_",
+            "type": "object",
+            "properties": {
+                name: {"$ref": f"#/definitions/{model_name_map[m]}"}
+                for name, m in models_by_name.items()
+            },
+            "required": list(models_by_name),
+            "additionalProperties": False,
+            "definitions": definitions,
+        }
 
-    finally:
-        for m, x in zip(models, model_extras):
-            if x is not None:
-                m.Config.extra = x
+    return dump_json_schema(schema)
+
+
+def split_command(cmd: str, posix: bool = os.name != "nt") -> List[str]:
+    """
+    Split a command (ex: 'yarn json2ts') into a list of arguments suitable for subprocess.
+
+    The executable is resolved to its full path when possible, which is required on Windows
+    for npm's '.cmd' shims to be found without going through a shell.
+    """
+    import shlex
+
+    args = shlex.split(cmd, posix=posix)
+    if not posix:
+        # Non-POSIX splitting keeps the quotes around tokens (ex: "C:\Program Files\..."),
+        # which subprocess would then escape rather than treat as quoting.
+        args = [a[1:-1] if len(a) > 1 and a[0] == a[-1] == '"' else a for a in args]
+    if args:
+        args[0] = shutil.which(args[0]) or args[0]
+    return args
+
+
+def run_json2ts(args: List[str], **kwargs) -> int:
+    """
+    Run json2ts and return its exit code.
+
+    If the executable cannot be found we return 127, which is what a shell would report.
+    """
+    import subprocess
+
+    try:
+        return subprocess.run(args, check=False, **kwargs).returncode
+    except FileNotFoundError:
+        return 127
 
 
 def generate_typescript_defs(
@@ -188,7 +325,8 @@ def generate_typescript_defs(
     :param output: file that the typescript definitions will be written to
     :param exclude: optional, a tuple of names for pydantic models which should be omitted from the typescript output.
     :param json2ts_cmd: optional, the command that will execute json2ts. Provide this if the executable is not
-                        discoverable or if it's locally installed (ex: 'yarn json2ts').
+                        discoverable or if it's locally installed (ex: 'yarn json2ts'). It is run without a
+                        shell, so shell syntax (ex: 'FOO=1 json2ts' or 'cd web && yarn json2ts') isn't supported.
     """
     if " " not in json2ts_cmd and not shutil.which(json2ts_cmd):
         raise Exception(
@@ -206,33 +344,53 @@ def generate_typescript_defs(
     logger.info("Generating JSON schema from pydantic models...")
 
     schema = generate_json_schema(models)
-    schema_dir = mkdtemp()
-    schema_file_path = os.path.join(schema_dir, "schema.json")
-
-    with open(schema_file_path, "w") as f:
-        f.write(schema)
 
     logger.info("Converting JSON schema to typescript definitions...")
 
-    json2ts_exit_code = os.system(
-        f'{json2ts_cmd} -i {schema_file_path} -o {output} --bannerComment ""'
-    )
+    from tempfile import mkdtemp
 
-    shutil.rmtree(schema_dir)
+    # json2ts writes to a temporary file rather than stdout, because wrappers such as
+    # 'yarn json2ts' print their own messages to stdout. The definitions are then cleaned up
+    # in memory, so the output file itself only has to be written once.
+    output_dir = mkdtemp()
+    try:
+        ts_file_path = os.path.join(output_dir, "output.ts")
+        json2ts_args = split_command(json2ts_cmd) + [
+            "-o",
+            ts_file_path,
+            "--bannerComment",
+            "",
+        ]
+
+        # The schema is piped through stdin (supported by json2ts for many major versions),
+        # which saves us from writing it to disk. json2ts' own errors go straight to stderr.
+        json2ts_exit_code = run_json2ts(json2ts_args, input=schema)
+
+        if json2ts_exit_code != 0:
+            raise RuntimeError(
+                f'"{json2ts_cmd}" failed with exit code {json2ts_exit_code}.'
+            )
+
+        typescript = Path(ts_file_path).read_text(encoding="utf-8")
+    finally:
+        shutil.rmtree(output_dir)
 
-    if json2ts_exit_code == 0:
-        clean_output_file(output)
-        logger.info(f"Saved typescript definitions to {output}.")
-    else:
-        raise RuntimeError(
-            f'"{json2ts_cmd}" failed with exit code {json2ts_exit_code}.'
-        )
+    typescript = remove_master_interface(typescript)
 
+    # json2ts used to write the output file itself, creating any missing parent directories.
+    output_path = Path(output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(_BANNER_COMMENT + typescript, encoding="utf-8")
 
-def parse_cli_args(args: List[str] = None) -> argparse.Namespace:
+    logger.info(f"Saved typescript definitions to {output}.")
+
+
+def parse_cli_args(args: List[str] = None) -> "argparse.Namespace":
     """
     Parses the command-line arguments passed to pydantic2ts.
     """
+    import argparse
+
     parser = argparse.ArgumentParser(
         prog="pydantic2ts",
         description=main.__doc__,
@@ -260,6 +418,7 @@ def parse_cli_args(args: List[str] = None) -> argparse.Namespace:
         default="json2ts",
         help="path to the json-schema-to-typescript executable.\n"
         "Provide this if it's not discoverable or if it's only installed locally (example: 'yarn json2ts').\n"
+        "It is run without a shell, so shell syntax (ex: 'cd web && yarn json2ts') isn't supported.\n"
         "(default: json2ts)",
     )
     return parser.parse_args(args)
@@ -38,6 +38,7 @@ setup(
     install_requires=install_requires,
     extras_require={
         "dev": ["pytest", "pytest-cov", "coverage"],
+        "orjson": ["orjson"],
     },
     entry_points={"console_scripts": ["pydantic2ts = pydantic2ts.cli.script:main"]},
     classifiers=classifiers,
@@ -1,11 +1,21 @@
+import json
 import os
 import subprocess
 import sys
 
 import pytest
 
+from pydantic import BaseConfig, BaseModel, Extra, create_model
+
 from pydantic2ts import generate_typescript_defs
-from pydantic2ts.cli.script import parse_cli_args
+from pydantic2ts.cli.script import (
+    extract_pydantic_models,
+    generate_json_schema,
+    import_module,
+    parse_cli_args,
+    remove_master_interface,
+    split_command,
+)
 
 
 def _results_directory() -> str:
@@ -100,6 +110,184 @@ def test_calling_from_python(tmpdir):
     )
 
 
+@pytest.mark.skipif(
+    sys.version_info < (3, 8),
+    reason="Literal requires python 3.8 or higher (Ref.: PEP 586)",
+)
+def test_extract_pydantic_models_skips_duplicates():
+    # 'Cat' and 'Dog' are imported into the input module but also defined in its submodules.
+    # Each model should only be returned once, in the order it was first encountered.
+    module = import_module(get_input_module("submodules"))
+    models = extract_pydantic_models(module)
+    assert [m.__name__ for m in models] == ["AnimalShelter", "Cat", "Dog"]
+
+
+def test_models_with_the_same_name():
+    # Models are keyed by class name in the '_Master_' object, so if two share a name
+    # (ex: defined in different submodules) only the last one is kept.
+    first_foo = create_model("Foo", __module__="pkg.a", a=(int, ...))
+    second_foo = create_model("Foo", __module__="pkg.b", b=(int, ...))
+    bar = create_model("Bar", x=(int, ...))
+
+    schema = json.loads(generate_json_schema([first_foo, bar, second_foo]))
+
+    assert schema["required"] == ["Foo", "Bar"]
+    assert list(schema["definitions"]) == ["Foo", "Bar"]
+    assert schema["properties"]["Foo"] == {"$ref": "#/definitions/Foo"}
+    assert list(schema["definitions"]["Foo"]["properties"]) == ["b"]
+
+
+def test_generate_json_schema_restores_extra():
+    class Parent(BaseModel):
+        class Config:
+            extra = Extra.ignore
+
+    class Inherited(Parent):
+        x: int
+
+    class ExplicitIgnore(BaseModel):
+        x: int
+
+        class Config:
+            extra = Extra.ignore
+
+    class NotSet(BaseModel):
+        x: int
+
+        class Config:
+            title = "NotSet"
+
+    class SubclassedConfig(BaseModel):
+        x: int
+
+        class Config(BaseConfig):
+            pass
+
+    models = [Inherited, ExplicitIgnore, NotSet, SubclassedConfig]
+    before = [getattr(m.Config, "extra", None) for m in models]
+    assert before == [Extra.ignore, Extra.ignore, None, Extra.ignore]
+
+    schema = json.loads(generate_json_schema(models))
+
+    for definition in schema["definitions"].values():
+        assert definition["additionalProperties"] is False
+    assert [getattr(m.Config, "extra", None) for m in models] == before
+    # An inherited setting shouldn't be turned into an override on the subclass.
+    assert "extra" not in vars(SubclassedConfig.Config)
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_remove_master_interface(newline):
+    typescript = newline.join(
+        [
+            "export interface Foo {",
+            "  bar: string;",
+            "}",
+            "export interface _Master_ {",
+            "  Foo: Foo;",
+            "  Nested: {",
+            "    baz: number;",
+            "  };",
+            "}",
+            "export interface Nested {",
+            "  baz: number;",
+            "}",
+            "",
+        ]
+    )
+    expected = newline.join(
+        [
+            "export interface Foo {",
+            "  bar: string;",
+            "}",
+            "export interface Nested {",
+            "  baz: number;",
+            "}",
+            "",
+        ]
+    )
+    assert remove_master_interface(typescript) == expected
+
+
+def _fake_json2ts_cmd(tmpdir) -> str:
+    """
+    Create a stand-in for json2ts which, like 'yarn json2ts', also prints messages to stdout.
+    It writes an empty interface for each definition (plus the '_Master_' interface) to its -o file.
+    """
+    fake_json2ts = tmpdir.join("fake_json2ts.py")
+    fake_json2ts.write(
+        "import json, sys\n"
+        "schema = json.load(sys.stdin)\n"
+        "print('yarn run v1.22.19')\n"
+        "print('$ /node_modules/.bin/json2ts ' + ' '.join(sys.argv[1:]))\n"
+        "with open(sys.argv[sys.argv.index('-o') + 1], 'w') as f:\n"
+        "    f.write('export interface _Master_ {\\n')\n"
+        "    for name in schema['properties']:\n"
+        "        f.write('  ' + name + ': ' + name + ';\\n')\n"
+        "    f.write('}\\n')\n"
+        "    for name in schema['definitions']:\n"
+        "        f.write('export interface ' + name + ' {}\\n')\n"
+        "print('Done in 0.42s.')\n"
+    )
+    return f"{sys.executable} {fake_json2ts.strpath}"
+
+
+def test_json2ts_stdout_is_not_written_to_output(tmpdir):
+    # Wrappers like 'yarn json2ts' print their own messages to stdout.
+    # Only the definitions json2ts writes to its output file should end up in the result.
+    output_path = tmpdir.join("fake_json2ts_output.ts").strpath
+
+    generate_typescript_defs(
+        get_input_module("single_module"),
+        output_path,
+        json2ts_cmd=_fake_json2ts_cmd(tmpdir),
+    )
+
+    with open(output_path, "r") as f:
+        output = f.read()
+    assert output.endswith(
+        "*/\n\n"
+        "export interface LoginCredentials {}\n"
+        "export interface Profile {}\n"
+        "export interface LoginResponseData {}\n"
+    )
+    assert "yarn" not in output
+    assert "Done in" not in output
+
+
+def test_output_directory_is_created(tmpdir):
+    output_path = tmpdir.join("generated", "api", "output.ts").strpath
+
+    generate_typescript_defs(
+        get_input_module("single_module"),
+        output_path,
+        json2ts_cmd=_fake_json2ts_cmd(tmpdir),
+    )
+
+    with open(output_path, "r") as f:
+        assert f.read().endswith("export interface LoginResponseData {}\n")
+
+
+@pytest.mark.parametrize(
+    "cmd, posix, expected",
+    [
+        ("yarn json2ts", True, ["yarn", "json2ts"]),
+        (
+            "'/opt/my tools/json2ts' --strictIndexSignatures",
+            True,
+            ["/opt/my tools/json2ts", "--strictIndexSignatures"],
+        ),
+        (
+            '"C:\\Program Files\\nodejs\\json2ts.cmd" --strictIndexSignatures',
+            False,
+            ["C:\\Program Files\\nodejs\\json2ts.cmd", "--strictIndexSignatures"],
+        ),
+    ],
+)
+def test_split_command(cmd, posix, expected):
+    assert split_command(cmd, posix=posix) == expected
+
+
 def test_error_if_json2ts_not_installed(tmpdir):
     module_path = get_input_module("single_module")
     output_path = tmpdir.join(f"cli_single_module.ts").strpath